@@ -3,17 +3,42 @@ import os
 from ynab import YNAB
 from dotenv import load_dotenv, dotenv_values
 import logging
+import logging.handlers
+import queue
+import atexit
+import copy
+import hashlib
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import argparse
 
 # Load environment variables from .env file
 env_values = dotenv_values()
 
-# Set up logging to both file and console
-def setup_logging():
+LOG_DIR = 'logs'
+LOG_FILE = 'ynab_amazon_update.log'
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+EVENTS_LOGGER = 'ynab_amazon.events'
+
+# Queue shared by all log handlers, drained by a background listener thread
+_log_queue = queue.Queue()
+
+class JsonEventFormatter(logging.Formatter):
+    """Format an event record as a single compact JSON line."""
+    def format(self, record):
+        event = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='seconds'),
+            'event': record.getMessage(),
+        }
+        event.update(getattr(record, 'fields', {}))
+        return json.dumps(event, separators=(',', ':'), default=str)
+
+# Set up logging to both file and console, written from a background thread
+def setup_logging(events_file=None):
     # Create logs directory if it doesn't exist
-    if not os.path.exists('logs'):
-        os.makedirs('logs')
+    if not os.path.exists(LOG_DIR):
+        os.makedirs(LOG_DIR)
     
     # Create a logger
     logger = logging.getLogger('ynab_amazon')
@@ -23,9 +48,9 @@ def setup_logging():
     file_formatter = logging.Formatter('%(asctime)s - %(message)s')
     console_formatter = logging.Formatter('%(message)s')
     
-    # File handler (with timestamp in filename)
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    file_handler = logging.FileHandler(f'logs/ynab_amazon_update_{timestamp}.log')
+    # File handler (rotated by size, keeping a fixed number of old logs)
+    file_handler = logging.handlers.RotatingFileHandler(
+        os.path.join(LOG_DIR, LOG_FILE), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
     file_handler.setLevel(logging.INFO)
     file_handler.setFormatter(file_formatter)
     
@@ -33,13 +58,39 @@ def setup_logging():
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.INFO)
     console_handler.setFormatter(console_formatter)
-    
-    # Add handlers to logger
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+
+    handlers = [file_handler, console_handler]
+    for handler in handlers:
+        handler.addFilter(lambda record: record.name != EVENTS_LOGGER)
+
+    # Event logger for the optional JSONL stream, kept out of the text logs
+    events_logger = logging.getLogger(EVENTS_LOGGER)
+    events_logger.setLevel(logging.INFO)
+    events_logger.propagate = False
+
+    if events_file:
+        events_handler = logging.FileHandler(events_file)
+        events_handler.setFormatter(JsonEventFormatter())
+        events_handler.addFilter(lambda record: record.name == EVENTS_LOGGER)
+        handlers.append(events_handler)
+        events_logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+    
+    # Loggers only enqueue records; the listener does the actual I/O
+    logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+    listener = logging.handlers.QueueListener(_log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
     
     return logger
 
+def flush_logging():
+    """Wait until all queued log records are written, e.g. before prompting the user."""
+    _log_queue.join()
+
+def log_event(event, **fields):
+    """Emit a transaction event to the JSONL event stream, if enabled."""
+    logging.getLogger(EVENTS_LOGGER).info(event, extra={'fields': fields})
+
 def load_json_file(filename):
     with open(filename, 'r') as f:
         return json.load(f)
@@ -69,32 +120,124 @@ def filter_transactions_by_date(transactions, from_date):
             filtered.append(txn)
     return filtered
 
-def find_matching_amazon_order(amazon_orders, ynab_transaction):
-    
-    ynab_amount = ynab_transaction['amount']
+# Amount keys each order is indexed under, in match priority order. Each key maps
+# to the order fields that were paid by other means (gift card, points, refund)
+# and are therefore subtracted from grand_total to get the card charge. When
+# grand_total is already net of the gift card and reward points, keys deducting
+# them don't apply and the credits are always part of the split.
+AMOUNT_KEY_DEDUCTIONS = {
+    'grand_total': (),
+    'net_gift_card': ('gift_card',),
+    'net_reward_points': ('reward_points',),
+    'net_gift_card_and_reward_points': ('gift_card', 'reward_points'),
+    'net_refund': ('refund_total',),
+}
+AMOUNT_KEYS = list(AMOUNT_KEY_DEDUCTIONS)
+CREDIT_FIELDS = ('gift_card', 'reward_points')
+
+def to_cents(value):
+    """Convert a dollar amount from the Amazon data to integer cents, or None if missing."""
+    if value is None or value == 'None':
+        return None
+    try:
+        return int(round(float(value) * 100))
+    except (TypeError, ValueError):
+        return None
+
+def build_amazon_order_index(amazon_orders):
+    """Index orders by every derived amount key so a transaction can be matched with a hash lookup."""
+    order_index = {}
+    for order in amazon_orders:
+        grand_total = to_cents(order.get('grand_total'))
+        if grand_total is None:
+            continue
+
+        includes_credits = grand_total_includes_credits(order)
+        seen_amounts = set()
+        for amount_key, deductions in AMOUNT_KEY_DEDUCTIONS.items():
+            if includes_credits and set(deductions) & set(CREDIT_FIELDS):
+                continue  # Credits are already taken out of grand_total
+            # Amazon reports credits as negative, but don't rely on the sign
+            deduction_values = [to_cents(order.get(field)) for field in deductions]
+            if any(not value for value in deduction_values):
+                continue  # Key doesn't apply to this order
+
+            amount = grand_total - sum(abs(value) for value in deduction_values)
+            # Only index an order once per amount, keeping the highest priority key
+            if amount in seen_amounts:
+                continue
+            seen_amounts.add(amount)
+            order_index.setdefault(amount, []).append((order, amount_key))
+    return order_index
+
+def find_matching_amazon_order(order_index, ynab_transaction):
+    """Find the order matching a YNAB transaction, returning (order, amount_key) or None."""
     ynab_order_date = datetime.strptime(ynab_transaction['date'], "%Y-%m-%d")
 
-    # Convert YNAB amount from milliunits to dollars
-    ynab_dollars = ynab_amount / -1000  # Changed to handle negative amount properly
-    
-    # Find orders with matching total amount
-    matching_orders = [
-        order for order in amazon_orders 
-        if order['grand_total'] is not None and abs(float(order['grand_total']) - ynab_dollars) < 0.01
-    ]
-    
+    # Convert YNAB amount from milliunits to cents (negative amount is an outflow)
+    ynab_cents = int(round(ynab_transaction['amount'] / -10))
+
+    matching_orders = order_index.get(ynab_cents)
     if not matching_orders:
         return None
 
-    # Return the order with the closest date
+    # Return the order with the closest date, preferring a grand total match on ties
     return min(
         matching_orders,
-        key=lambda order: abs(
-            datetime.strptime(order['date'], "%Y-%m-%d") - ynab_order_date)
+        key=lambda match: (
+            abs(datetime.strptime(match[0]['date'], "%Y-%m-%d") - ynab_order_date),
+            AMOUNT_KEYS.index(match[1]))
     )
 
+def get_credit_amount(order, field):
+    """Return a gift card, reward points or refund value as a negative float, or None if missing."""
+    value = order.get(field)
+    if value is None or value == 'None' or float(value) == 0:
+        return None
+    # Amazon reports credits as negative, but don't rely on the sign
+    return -abs(float(value))
+
+def grand_total_includes_credits(order):
+    """Tell whether grand_total is already net of the gift card and reward points.
+
+    Builds the split with the credits applied and compares it to grand_total.
+    Otherwise (including orders whose items have no price) grand_total is
+    treated as the gross amount.
+    """
+    grand_total = to_cents(order.get('grand_total'))
+    credits = {field: get_credit_amount(order, field) for field in CREDIT_FIELDS}
+    if grand_total is None or not any(credits.values()):
+        return False
+
+    subtransactions, _ = create_subtransactions(
+        order.get('items', []),
+        estimated_tax=order.get('estimated_tax'),
+        coupon_savings=order.get('coupon_savings'),
+        subscription_discount=order.get('subscription_discount'),
+        shipping_total=order.get('shipping_total'),
+        free_shipping=order.get('free_shipping'),
+        promotion_applied=order.get('promotion_applied'),
+        multibuy_discount=order.get('multibuy_discount'),
+        amazon_discount=order.get('amazon_discount'),
+        gift_wrap=order.get('gift_wrap'),
+        **credits
+    )
+    net_total = int(round(sum(sub['amount'] for sub in subtransactions) / -10))
+    return abs(net_total - grand_total) <= 1
+
+def get_deductions_for_key(order, amount_key):
+    """Return the gift card, reward points and refund values to split out for a matched amount key."""
+    applied = set(AMOUNT_KEY_DEDUCTIONS[amount_key])
+    if grand_total_includes_credits(order):
+        applied.update(CREDIT_FIELDS)
+    return {
+        field: get_credit_amount(order, field) if field in applied else None
+        for field in ('gift_card', 'reward_points', 'refund_total')
+    }
+
 def create_subtransactions(items, estimated_tax=None, order_total=None, ynab_amount=None, coupon_savings=None, subscription_discount=None, shipping_total=None,
-                           free_shipping=None, reward_points=None, promotion_applied=None, multibuy_discount=None, amazon_discount=None, gift_card=None, gift_wrap=None):
+                           free_shipping=None, reward_points=None, promotion_applied=None, multibuy_discount=None, amazon_discount=None, gift_card=None, gift_wrap=None,
+                           refund_total=None):
     subtransactions = []
     items_with_no_price = []
     subtotal = 0
@@ -246,18 +389,142 @@ def create_subtransactions(items, estimated_tax=None, order_total=None, ynab_amo
             "memo": "Gift Card"
         })
 
+    # Add refund if present (as positive amount, the refund reduces the charge)
+    if refund_total and refund_total != 'None' and float(refund_total) != 0:
+        refund_amount = int(round(abs(float(refund_total)) * 1000))
+        subtotal += refund_amount
+        subtransactions.append({
+            "amount": refund_amount,
+            "payee_name": "Amazon",
+            "memo": "Refund"
+        })
+
+    reconcile_rounding(subtransactions, ynab_amount, subtotal)
+    
+    return subtransactions, items_with_no_price
+
+def reconcile_rounding(subtransactions, ynab_amount, subtotal=None):
+    """Absorb a rounding difference of up to 1 cent into the largest subtransaction."""
     # If we have the YNAB amount, adjust the subtransactions to match it exactly
     if ynab_amount and subtransactions:
+        if subtotal is None:
+            subtotal = sum(sub['amount'] for sub in subtransactions)
         difference = ynab_amount - subtotal
         if abs(difference) <= 10:  # If difference is 1 cent or less
             # Add the difference to the largest subtransaction to minimize rounding impact
             largest_sub = max(subtransactions, key=lambda x: abs(x['amount']))
             largest_sub['amount'] += difference
-    
-    return subtransactions, items_with_no_price
+
+# Order fields that affect the split, in addition to the items
+ADJUSTMENT_FIELDS = (
+    'grand_total', 'estimated_tax', 'coupon_savings', 'subscription_discount', 'shipping_total',
+    'free_shipping', 'reward_points', 'promotion_applied', 'multibuy_discount', 'amazon_discount',
+    'gift_card', 'gift_wrap', 'refund_total',
+)
+
+def get_order_signature(order, amount_key):
+    """Build a key identifying orders that produce the same split, e.g. recurring Subscribe & Save orders."""
+    items = [
+        [(item.get('title') or '').strip(), str(item.get('quantity') or 1), to_cents(item.get('price'))]
+        for item in order.get('items', [])
+    ]
+    adjustments = [to_cents(order.get(field)) for field in ADJUSTMENT_FIELDS]
+    signature = json.dumps([items, adjustments, amount_key], separators=(',', ':'))
+    return hashlib.sha1(signature.encode('utf-8')).hexdigest()
+
+class SubtransactionTemplateCache:
+    """LRU cache of verified splits keyed by order signature, persisted between runs.
+
+    A template holds the verified subtransactions, including manual
+    adjustments, as they were before the sales tax was redistributed, so it
+    can be reused with either sales tax mode. It also holds the items that
+    had no price.
+    """
+    FILENAME = 'subtransaction_templates.json'
+    MAX_SIZE = 500
+
+    def __init__(self, filename=FILENAME, max_size=MAX_SIZE):
+        self.filename = filename
+        self.max_size = max_size
+        self.templates = OrderedDict()
+
+    def load(self):
+        """Load templates from disk, least recently used first."""
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename, 'r') as f:
+                    self.templates = OrderedDict(json.load(f))
+            except (json.JSONDecodeError, FileNotFoundError):
+                self.templates = OrderedDict()
+
+    def save(self):
+        with open(self.filename, 'w') as f:
+            json.dump(self.templates, f, indent=2)
+
+    def get(self, signature):
+        """Return a copy of the template for a signature, or None."""
+        template = self.templates.get(signature)
+        if template is None:
+            return None
+        self.templates.move_to_end(signature)
+        return copy.deepcopy(template)
+
+    def put(self, signature, template):
+        self.templates[signature] = copy.deepcopy(template)
+        self.templates.move_to_end(signature)
+        while len(self.templates) > self.max_size:
+            self.templates.popitem(last=False)
+
+    def learn_categories(self, signature, posted_subtransactions):
+        """Copy the categories of subtransactions posted to YNAB onto the template with the same memos."""
+        template = self.templates.get(signature)
+        if template is None:
+            return False
+
+        categories = {
+            sub.get('memo'): sub['category_id'] for sub in posted_subtransactions
+            if sub.get('category_id') and not sub.get('deleted')
+        }
+        learned = False
+        for sub in template['subtransactions']:
+            category_id = categories.get(sub.get('memo'))
+            if category_id and sub.get('category_id') != category_id:
+                sub['category_id'] = category_id
+                learned = True
+        return learned
+
+def learn_template_categories(template_cache, order_index, amazon_orders, ynab_transactions):
+    """Update saved splits with categories assigned in YNAB after they were posted.
+
+    Returns the number of templates that changed.
+    """
+    orders_by_link = {order['order_details_link']: order for order in amazon_orders}
+    learned = 0
+    for txn in ynab_transactions:
+        if not txn.get('subtransactions'):
+            continue
+
+        # Previously updated transactions have the order link in the memo
+        memo = txn.get('memo', '') or ''
+        order = next((orders_by_link[word] for word in memo.split() if word in orders_by_link), None)
+        if order is None:
+            continue
+
+        # Find the amount key the transaction was matched on
+        ynab_cents = int(round(txn['amount'] / -10))
+        amount_key = next(
+            (key for indexed_order, key in order_index.get(ynab_cents, []) if indexed_order is order), None)
+        if amount_key is None:
+            continue
+
+        if template_cache.learn_categories(get_order_signature(order, amount_key), txn['subtransactions']):
+            learned += 1
+    return learned
 
 def handle_transaction_mismatch(update, matching_order, difference):
     """Handle a transaction amount mismatch by allowing user to add missing items or gift card amounts."""
+    # Make sure the mismatch details are on screen before prompting
+    flush_logging()
     print(f"\nHandling mismatch for order: {matching_order['order_details_link']}")
     print(f"Current difference: ${abs(difference)/1000:.2f}")
     print("\nOptions:")
@@ -331,40 +598,65 @@ def handle_transaction_mismatch(update, matching_order, difference):
         
     return False
 
-def verify_transaction_amounts(updates_preview, matching_orders_map, logger):
-    """Verify transaction amounts and handle mismatches."""
-    has_mismatches = False
-    fixed_transactions = []
-    
-    for i, update in enumerate(updates_preview):
-        while True:  # Keep trying to fix the transaction until it matches or user skips
+def build_verification_report(updates_preview):
+    """Check every update's subtransactions against its amount in one pass.
+
+    Returns a report with a result per update, in order, and the same results
+    split into matched and mismatched lists. Nothing is fixed here, so the
+    whole batch is checked before any user interaction.
+    """
+    report = {'results': [], 'matched': [], 'mismatched': []}
+    for i, update in enumerate(updates_preview, 1):
+        sub_total = sum(sub['amount'] for sub in update['subtransactions'])
+        difference = update['amount'] - sub_total
+        result = {'index': i, 'update': update, 'sub_total': sub_total, 'difference': difference}
+        report['results'].append(result)
+        if abs(difference) <= 1:  # Transaction matches
+            report['matched'].append(result)
+        else:
+            report['mismatched'].append(result)
+    return report
+
+def log_transaction_mismatch(index, update, sub_total, matching_order, logger):
+    """Log the details of a transaction whose subtransactions don't add up."""
+    logger.error(f"\nTransaction {index} amount mismatch:")
+    logger.error(f"Order link: {matching_order['order_details_link']}")
+    logger.error(f"Amazon order total: ${float(matching_order['grand_total']):.2f}")
+    logger.error(f"Raw YNAB amount (milliunits): {update['amount']}")
+    logger.error(f"Raw subtotal (milliunits): {sub_total}")
+    logger.error(f"Transaction amount: ${update['amount']/-1000:.2f}")
+    logger.error(f"Sum of subtransactions: ${sub_total/-1000:.2f}")
+    logger.error("Subtransactions:")
+    for sub in update['subtransactions']:
+        logger.error(f"  - ${sub['amount']/-1000:.2f}: {sub['memo']}")
+    logger.error(f"Difference: ${(update['amount'] - sub_total)/-1000:.2f}")
+    log_event('mismatched', transaction_id=update['id'], order_number=matching_order.get('order_number'),
+              amount=update['amount'], subtotal=sub_total, difference=update['amount'] - sub_total)
+
+def resolve_mismatches(report, matching_orders_map, logger):
+    """Interactively fix the mismatched updates in a verification report.
+
+    Returns the updates whose amounts match, either originally or after fixing.
+    """
+    fixed_transactions = [result['update'] for result in report['matched']]
+
+    for result in report['mismatched']:
+        update = result['update']
+        matching_order = matching_orders_map[update['id']]
+        difference = result['difference']
+
+        # Keep trying to fix the transaction until it matches or user skips
+        while handle_transaction_mismatch(update, matching_order, difference):
             sub_total = sum(sub['amount'] for sub in update['subtransactions'])
             difference = update['amount'] - sub_total
-            
+
             if abs(difference) <= 1:  # Transaction matches
-                if update not in fixed_transactions:
-                    fixed_transactions.append(update)
+                fixed_transactions.append(update)
                 break
-                
-            has_mismatches = True
-            matching_order = matching_orders_map[update['id']]
-            
-            logger.error(f"\nTransaction {i} amount mismatch:")
-            logger.error(f"Order link: {matching_order['order_details_link']}")
-            logger.error(f"Amazon order total: ${float(matching_order['grand_total']):.2f}")
-            logger.error(f"Raw YNAB amount (milliunits): {update['amount']}")
-            logger.error(f"Raw subtotal (milliunits): {sub_total}")
-            logger.error(f"Transaction amount: ${update['amount']/-1000:.2f}")
-            logger.error(f"Sum of subtransactions: ${sub_total/-1000:.2f}")
-            logger.error("Subtransactions:")
-            for sub in update['subtransactions']:
-                logger.error(f"  - ${sub['amount']/-1000:.2f}: {sub['memo']}")
-            logger.error(f"Difference: ${(update['amount'] - sub_total)/-1000:.2f}")
-            
-            if not handle_transaction_mismatch(update, matching_order, difference):
-                break  # User chose to skip
-            
-    return has_mismatches, fixed_transactions
+
+            log_transaction_mismatch(result['index'], update, sub_total, matching_order, logger)
+
+    return fixed_transactions
 
 # Redistribute sales tax evenly across subtransactions, removing the original Sales Tax line
 def redistribute_sales_tax(payload):
@@ -396,17 +688,19 @@ def redistribute_sales_tax(payload):
     return payload
 
 def main():
-    # Set up logging
-    logger = setup_logging()
-    
-    logger.info("Starting YNAB Amazon transaction update process")
-    
     # Load command line arguments
     parser = argparse.ArgumentParser(description='Update YNAB orders with details from Amazon transactions')
     parser.add_argument('--preserve-sales-tax-line', action='store_true', help='Keep sales tax a separate item')
     parser.add_argument('--from-date', type=str, help='Process transactions from this date forward (YYYY-MM-DD format)')
+    parser.add_argument('--no-template-cache', action='store_true', help='Always rebuild splits instead of reusing splits from previous orders with the same items')
+    parser.add_argument('--events-file', type=str, help='Write a JSONL event per matched, skipped, mismatched or applied transaction to this file')
     args = parser.parse_args()
 
+    # Set up logging
+    logger = setup_logging(args.events_file)
+    
+    logger.info("Starting YNAB Amazon transaction update process")
+
     # Load data from JSON files
     amazon_orders = load_json_file('amazon_orders.json')
     ynab_transactions = load_json_file('ynab_amazon_transactions.json')
@@ -440,6 +734,7 @@ def main():
     
     # Filter transactions by date
     original_count = len(ynab_transactions)
+    all_transactions = ynab_transactions
     ynab_transactions = filter_transactions_by_date(ynab_transactions, from_date)
     
     logger.info(f"Loaded {len(amazon_orders)} Amazon orders and {original_count} YNAB transactions")
@@ -454,23 +749,49 @@ def main():
     orders_with_no_price_items = {}
     # Store matching orders for verification
     matching_orders_map = {}
+    # Store which amount key each transaction matched on
+    match_keys_map = {}
+    # Store order signatures for saving split templates
+    signatures_map = {}
+
+    # Load splits from previous runs for recurring orders
+    template_cache = SubtransactionTemplateCache()
+    if not args.no_template_cache:
+        template_cache.load()
+
+    # Index orders by grand total and derived amounts (net of gift card, points, refund)
+    order_index = build_amazon_order_index(amazon_orders)
+
+    # Learn the categories assigned in YNAB to previously updated transactions
+    if not args.no_template_cache:
+        learned = learn_template_categories(template_cache, order_index, amazon_orders, all_transactions)
+        if learned:
+            logger.info(f"Learned categories for {learned} saved splits")
+            template_cache.save()
     
     # Process each YNAB transaction
     for txn in ynab_transactions:
         # Skip transactions that already have subtransactions (already processed)
         if txn.get('subtransactions') and len(txn['subtransactions']) > 0:
             logger.info(f"Skipping transaction {txn['id']} - already has {len(txn['subtransactions'])} subtransactions")
+            log_event('skipped', transaction_id=txn['id'], reason='has_subtransactions')
             continue
             
         # Skip transactions that already have Amazon order links in memo (already processed)
         memo = txn.get('memo', '') or ''
         if 'amazon.com/gp/your-account/order-details' in memo:
             logger.info(f"Skipping transaction {txn['id']} - already has Amazon order link in memo")
+            log_event('skipped', transaction_id=txn['id'], reason='has_order_link')
             continue
             
-        matching_order = find_matching_amazon_order(amazon_orders, txn)
+        match = find_matching_amazon_order(order_index, txn)
         
-        if matching_order:
+        if match:
+            matching_order, amount_key = match
+            if amount_key != 'grand_total':
+                logger.info(f"Matched transaction {txn['id']} on {amount_key}")
+            log_event('matched', transaction_id=txn['id'], order_number=matching_order.get('order_number'),
+                      amount=txn['amount'], amount_key=amount_key)
             update = {
                 "account_id": txn['account_id'],
                 "id": txn['id'],
@@ -487,59 +808,82 @@ def main():
             
             # Store matching order for verification
             matching_orders_map[update['id']] = matching_order
+            match_keys_map[update['id']] = amount_key
+            deductions = get_deductions_for_key(matching_order, amount_key)
+            signature = get_order_signature(matching_order, amount_key)
+            signatures_map[update['id']] = signature
+            template = None if args.no_template_cache else template_cache.get(signature)
             
-            # Add subtransactions and track items with no price
-            update['subtransactions'], no_price_items = create_subtransactions(
-                matching_order['items'], 
-                matching_order.get('estimated_tax'),
-                matching_order.get('grand_total'),
-                txn['amount'],  # Pass YNAB amount for exact matching
-                matching_order.get('coupon_savings'),
-                matching_order.get('subscription_discount'),
-                matching_order.get('shipping_total'),
-                matching_order.get('free_shipping'),
-                matching_order.get('reward_points'),
-                matching_order.get('promotion_applied'),
-                matching_order.get('multibuy_discount'),
-                matching_order.get('amazon_discount'),
-                matching_order.get('gift_card'),
-                matching_order.get('gift_wrap')
-            )
+            if template:
+                # Reuse the split from a previous identical order, only redoing the rounding
+                logger.info(f"Using saved split for transaction {txn['id']}")
+                update['subtransactions'] = template['subtransactions']
+                no_price_items = template['items_with_no_price']
+                reconcile_rounding(update['subtransactions'], txn['amount'])
+            else:
+                # Add subtransactions and track items with no price
+                update['subtransactions'], no_price_items = create_subtransactions(
+                    matching_order['items'], 
+                    matching_order.get('estimated_tax'),
+                    matching_order.get('grand_total'),
+                    txn['amount'],  # Pass YNAB amount for exact matching
+                    matching_order.get('coupon_savings'),
+                    matching_order.get('subscription_discount'),
+                    matching_order.get('shipping_total'),
+                    matching_order.get('free_shipping'),
+                    deductions['reward_points'],
+                    matching_order.get('promotion_applied'),
+                    matching_order.get('multibuy_discount'),
+                    matching_order.get('amazon_discount'),
+                    deductions['gift_card'],
+                    matching_order.get('gift_wrap'),
+                    deductions['refund_total']
+                )
             if no_price_items:
                 orders_with_no_price_items[matching_order['order_details_link']] = no_price_items
             
             update['num_items'] = len(matching_order['items'])  # Store number of items for preview
             
             updates_preview.append(update)
+        else:
+            log_event('skipped', transaction_id=txn['id'], reason='no_matching_order', amount=txn['amount'])
     
     logger.info(f"Found {len(updates_preview)} matching transactions to update")
     
     # Sort updates by number of items (descending) to show multi-item transactions first
     updates_preview.sort(key=lambda x: x['num_items'], reverse=True)
     
-    # Preview the first 10 updates and check amounts
+    # Verify all transactions before previewing and sending
+    logger.info("\nVerifying all transaction amounts...")
+    report = build_verification_report(updates_preview)
+    logger.info(f"{len(report['matched'])} transactions match, {len(report['mismatched'])} have amount mismatches")
+    
+    # Preview the first 10 updates
     logger.info("\nPreview of updates (first 10 transactions, prioritizing multi-item orders):")
-    for i, update in enumerate(updates_preview[:10], 1):
-        logger.info(f"\nTransaction {i} ({update['num_items']} items):")
+    for result in report['results'][:10]:
+        update = result['update']
+        logger.info(f"\nTransaction {result['index']} ({update['num_items']} items):")
         logger.info(f"Memo: {update['memo']}")
+        logger.info(f"Matched on: {match_keys_map[update['id']]}")
         logger.info(f"Original transaction amount: ${abs(update['amount'])/1000:.2f}")
         logger.info("Subtransactions:")
-        total_amount = 0
         for sub in update['subtransactions']:
-            amount = abs(sub['amount'])/1000
-            total_amount += amount
-            logger.info(f"  - ${amount:.2f}: {sub['memo']}")
-        logger.info(f"Sum of subtransactions: ${total_amount:.2f}")
+            logger.info(f"  - ${abs(sub['amount'])/1000:.2f}: {sub['memo']}")
+        logger.info(f"Sum of subtransactions: ${abs(result['sub_total'])/1000:.2f}")
     
-    # Verify all transactions before sending
-    logger.info("\nVerifying all transaction amounts...")
-    has_mismatches, fixed_transactions = verify_transaction_amounts(updates_preview, matching_orders_map, logger)
+    # Report all mismatches, then fix them interactively
+    for result in report['mismatched']:
+        log_transaction_mismatch(result['index'], result['update'], result['sub_total'],
+                                 matching_orders_map[result['update']['id']], logger)
+    has_mismatches = bool(report['mismatched'])
+    fixed_transactions = resolve_mismatches(report, matching_orders_map, logger)
     
     if has_mismatches and not fixed_transactions:
         logger.error("\n❌ Found amount mismatches that could not be fixed. Please review and try again.")
         return
     
     # Ask for confirmation
+    flush_logging()
     response = input("\nDo you want to proceed with these updates? (y/n): ")
     
     if response.lower() == 'y':
@@ -550,6 +894,16 @@ def main():
             budget_id = env_values.get("YNAB_BUDGET_ID")
             logger.info(f"Using YNAB Budget ID: {budget_id}")
 
+            # Copy the verified splits before the sales tax mode is applied to them
+            verified_templates = [
+                (signatures_map[update['id']], {
+                    'subtransactions': copy.deepcopy(update['subtransactions']),
+                    'items_with_no_price': orders_with_no_price_items.get(
+                        matching_orders_map[update['id']]['order_details_link'], []),
+                })
+                for update in fixed_transactions
+            ]
+
             if not args.preserve_sales_tax_line:
                 payload = redistribute_sales_tax(payload)
 
@@ -558,12 +912,21 @@ def main():
             # Check if the update was successful
             if status_code == 200 and response.get('data'):
                 logger.info("Updates completed successfully!")
+                for update in payload['transactions']:
+                    log_event('applied', transaction_id=update['id'], amount=update['amount'],
+                              subtransactions=len(update['subtransactions']))
                 
                 # Update last run date in data.json
                 today = datetime.now().strftime('%Y-%m-%d')
                 data['last_run'] = today
                 save_data_file(data)
                 logger.info(f"Updated last run date to: {today}")
+
+                # Remember verified splits so recurring orders can reuse them
+                if not args.no_template_cache:
+                    for signature, template in verified_templates:
+                        template_cache.put(signature, template)
+                    template_cache.save()
                 
                 # Show items with no price for manual review
                 if orders_with_no_price_items: